@@ -6,7 +6,6 @@ from threading import Thread
 from time import sleep
 from typing import IO
 
-import requests
 import simplebot
 from deltachat import Chat, Contact, Message
 from pkg_resources import DistributionNotFound, get_distribution
@@ -14,6 +13,7 @@ from simplebot.bot import DeltaBot, Replies
 
 from .database import DBManager
 from .irc import IRCBot
+from .monitor import HandlerMonitor
 
 try:
     __version__ = get_distribution(__name__).version
@@ -21,13 +21,7 @@ except DistributionNotFound:
     # package is not installed
     __version__ = "0.0.0.dev0-unknown"
 nick_re = re.compile(r"[-_a-zA-Z0-9]{1,30}$")
-session = requests.Session()
-session.headers.update(
-    {
-        "user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0"
-    }
-)
-session.request = functools.partial(session.request, timeout=15)  # type: ignore
+session = None  # requests.Session, created on the first upload
 db: DBManager
 irc_bridge: IRCBot
 
@@ -37,6 +31,10 @@ def deltabot_init(bot: DeltaBot) -> None:
     _getdefault(bot, "uploads_url", "https://0x0.st/")
     _getdefault(bot, "nick", "DC-Bridge")
     _getdefault(bot, "host", "irc.libera.chat:6667")
+    _getdefault(bot, "max_pvchats_user", "5")
+    _getdefault(bot, "max_pvchats_global", "50")
+    _getdefault(bot, "instrumentation", "0")
+    _getdefault(bot, "stall_threshold", "10")
 
 
 @simplebot.hookimpl
@@ -47,9 +45,17 @@ def deltabot_start(bot: DeltaBot) -> None:
     host_parts = _getdefault(bot, "host").split(":")
     host = host_parts[0]
     port = int(host_parts[1]) if len(host_parts) == 2 else 6667
-    irc_bridge = IRCBot((host, port), nick, db, bot)
-    bot.logger.debug("Sleeping 10 seconds to avoid throttle...")
-    sleep(10)
+    monitor = HandlerMonitor(bot.logger, float(_getdefault(bot, "stall_threshold")))
+    monitor.set_enabled(_getdefault(bot, "instrumentation") == "1")
+    irc_bridge = IRCBot(
+        (host, port),
+        nick,
+        db,
+        bot,
+        int(_getdefault(bot, "max_pvchats_user")),
+        int(_getdefault(bot, "max_pvchats_global")),
+        monitor,
+    )
     Thread(target=_run_irc, args=(bot,), daemon=True).start()
 
 
@@ -79,10 +85,16 @@ def deltabot_member_removed(bot: DeltaBot, chat: Chat, contact: Contact) -> None
     if pvchat:
         if bot.self_contact == contact or len(chat.get_contacts()) <= 1:
             db.remove_pvchat(pvchat["addr"], pvchat["nick"])
+        return
+
+    addr = db.get_inbox_by_gid(chat.id)
+    if addr:
+        if bot.self_contact == contact or len(chat.get_contacts()) <= 1:
+            db.remove_inbox(addr)
 
 
 @simplebot.filter
-def dc2irc(bot: DeltaBot, message: Message) -> None:
+def dc2irc(bot: DeltaBot, message: Message, replies: Replies) -> None:
     """I will send to IRC any message you send in a Delta Chat group bridged to an IRC room.
 
     At the same time, I will send to the Delta Chat group any message sent in the bridged IRC room.
@@ -95,6 +107,9 @@ def dc2irc(bot: DeltaBot, message: Message) -> None:
         if pvchat:
             target = pvchat["nick"]
             addr = pvchat["addr"]
+        elif db.get_inbox_by_gid(message.chat.id):
+            replies.add(text="❌ To reply, open a private chat with /query <nick>")
+            return
     if not target:
         return
 
@@ -160,6 +175,8 @@ def topic(message: Message, replies: Replies) -> None:
     chan = db.get_channel_by_gid(message.chat.id)
     if not chan:
         replies.add(text="❌ This is not an IRC channel")
+    elif not irc_bridge.is_ready():
+        replies.add(text=irc_bridge.get_status())
     else:
         replies.add(text=f"Topic:\n{irc_bridge.get_topic(chan)}")
 
@@ -171,6 +188,9 @@ def names(message: Message, replies: Replies) -> None:
     if not chan:
         replies.add(text="❌ This is not an IRC channel")
         return
+    if not irc_bridge.is_ready():
+        replies.add(text=irc_bridge.get_status())
+        return
 
     html = "👥 Members: <ul>"
     count = 0
@@ -182,6 +202,12 @@ def names(message: Message, replies: Replies) -> None:
     replies.add(text=f"👥 Members ({count})", html=html)
 
 
+@simplebot.command(name="/ircstatus")
+def status(replies: Replies) -> None:
+    """Show the IRC bridge connection status."""
+    replies.add(text=irc_bridge.get_status())
+
+
 @simplebot.command(name="/nick")
 def nick_cmd(args: list, message: Message, replies: Replies) -> None:
     """Set your IRC nick or display your current nick if no new nick is given."""
@@ -283,7 +309,81 @@ def remove(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> N
             return
 
 
+@simplebot.command(admin=True)
+def whitelist(payload: str, message: Message, replies: Replies) -> None:
+    """Manage the channels users can join.
+
+    Send /whitelist to get the current whitelist as a file.
+    Send /whitelist add #channel #project-* to add channels or glob patterns,
+    a text file with one channel per line can also be attached.
+    Send /whitelist remove #channel to remove channels from the whitelist.
+    If the whitelist is empty, users can join any channel.
+    """
+    args = payload.split()
+    if not args:
+        channels = db.get_whitelist()
+        if not channels:
+            replies.add(text="The whitelist is empty, all channels are allowed")
+            return
+        data = io.BytesIO("\n".join(channels).encode())
+        replies.add(
+            text=f"Whitelist ({len(channels)})", filename="whitelist.txt", bytefile=data
+        )
+        return
+
+    action, channels = args[0], args[1:]
+    if action == "add" and message.filename:
+        with open(message.filename, encoding="utf-8", errors="ignore") as file:
+            channels.extend(file.read().split())
+    if not channels or action not in ("add", "remove"):
+        replies.add(text="❌ Wrong syntax")
+    elif action == "add":
+        count = db.add_to_whitelist(channels)
+        replies.add(text=f"✔️ Added {count} channels to the whitelist")
+    else:
+        count = db.remove_from_whitelist(channels)
+        replies.add(text=f"✔️ Removed {count} channels from the whitelist")
+
+
+@simplebot.command(admin=True)
+def ircprofile(payload: str, message: Message, replies: Replies) -> None:
+    """Inspect the IRC bridge event handlers.
+
+    Send /ircprofile on to time the handlers and log the ones blocking the bridge,
+    /ircprofile off to disable it and /ircprofile stats to see the collected timings.
+    Send /ircprofile 30 to sample the bridge threads for 30 seconds,
+    /ircprofile stop stops the sampling earlier.
+    """
+    monitor = irc_bridge.monitor
+    if payload == "on":
+        monitor.set_enabled(True)
+        replies.add(text="✔️ Handler timing enabled")
+    elif payload == "off":
+        monitor.set_enabled(False)
+        replies.add(text="✔️ Handler timing disabled")
+    elif payload == "stats":
+        replies.add(text=monitor.get_stats() or "No timings collected yet")
+    elif payload == "stop":
+        if monitor.stop_sampling():
+            replies.add(text="✔️ Sampling stopped")
+        else:
+            replies.add(text="❌ No sampling is running")
+    elif payload.isdigit():
+        args = (monitor, int(payload), message.chat)
+        Thread(target=_send_profile, args=args, daemon=True).start()
+        replies.add(text=f"⏳ Sampling the bridge threads for {payload} seconds...")
+    else:
+        replies.add(text="❌ Wrong syntax")
+
+
+def _send_profile(monitor: HandlerMonitor, seconds: int, chat: Chat) -> None:
+    report = monitor.sample(seconds)
+    chat.send_text(report or "❌ Another sampling is already running")
+
+
 def _run_irc(bot: DeltaBot) -> None:
+    bot.logger.debug("Sleeping 10 seconds to avoid throttle...")
+    sleep(10)
     while True:
         try:
             bot.logger.debug("[bot] Connecting...")
@@ -316,6 +416,17 @@ def _add_contact(chat: Chat, contact: Contact) -> None:
 
 
 def _upload(filename: str, file: IO, url: str) -> str:
+    global session
+    import requests  # noqa, deferred until the first upload
+
+    if session is None:
+        session = requests.Session()
+        session.headers.update(
+            {
+                "user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0"
+            }
+        )
+        session.request = functools.partial(session.request, timeout=15)  # type: ignore
     try:
         with session.post(url, files=dict(file=(filename, file))) as resp:
             resp.raise_for_status()
@@ -1,6 +1,19 @@
+import fnmatch
+import re
 import sqlite3
 import string
-from typing import Generator, Optional
+import time
+from threading import Lock
+from typing import Dict, Generator, Iterable, List, Optional, Pattern, Set, Tuple
+
+_casemap = str.maketrans(
+    string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^"
+)
+
+
+def irc_lower(text: str) -> str:
+    """Lowercase text following the IRC "rfc1459" casemapping."""
+    return text.translate(_casemap)
 
 
 class DBManager:
@@ -18,6 +31,10 @@ class DBManager:
                 (addr TEXT, nick TEXT, chat INTEGER,
                 PRIMARY KEY(addr, nick))"""
             )
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS inboxes
+                (addr TEXT PRIMARY KEY, chat INTEGER)"""
+            )
             self.db.execute(
                 """CREATE TABLE IF NOT EXISTS nicks
                 (addr TEXT PRIMARY KEY,
@@ -28,9 +45,32 @@ class DBManager:
                 (channel TEXT PRIMARY KEY)"""
             )
 
-        for addr, nick in self.db.execute("SELECT addr, nick from nicks"):
+        self._pvchats_lock = Lock()
+        self._pvchats: Dict[Tuple[str, str], int] = {
+            (r["addr"], r["nick"]): r["chat"]
+            for r in self.execute("SELECT * FROM pvchats")
+        }
+
+        self._whitelist_lock = Lock()
+        self._whitelist: Optional[Tuple[Set[str], Optional[Pattern]]] = None
+
+        self._nicks_lock = Lock()
+        self._nicks: Dict[str, str] = {}  # addr -> nick
+        self._addrs: Dict[str, str] = {}  # lowercased nick -> addr
+        # lowercased nicks in use on the network -> expiration time
+        self._reserved: Dict[str, float] = {}
+        self._suffixes: Dict[str, int] = {}  # lowercased prefix -> next suffix
+        self._unused: Set[str] = set()  # addrs with nicks never used on IRC
+        for addr, nick in self.db.execute("SELECT addr, nick from nicks").fetchall():
             if nick != nick.rstrip("_"):
-                self.set_nick(addr, nick.rstrip("_"))
+                nick = nick.rstrip("_")
+                self.commit("REPLACE INTO nicks VALUES (?,?)", (addr, nick))
+            self._nicks[addr] = nick
+            self._addrs[irc_lower(nick)] = addr
+            name = nick.rstrip(string.digits)
+            suffix = int(nick[len(name) :]) if name and name != nick else 1
+            prefix = irc_lower(name or nick)
+            self._suffixes[prefix] = max(self._suffixes.get(prefix, 1), suffix + 1)
 
     def execute(self, statement: str, args=()) -> sqlite3.Cursor:
         return self.db.execute(statement, args)
@@ -44,23 +84,48 @@ class DBManager:
 
     # ==== pvchats =====
 
+    def find_pvchat(self, addr: str, nick: str) -> Optional[int]:
+        """Get the private chat with the given nick without creating it."""
+        return self._pvchats.get((addr, nick))
+
     def get_pvchat(self, addr: str, nick: str) -> int:
-        r = self.execute(
-            "SELECT chat FROM pvchats WHERE addr=? AND nick=?", (addr, nick)
-        ).fetchone()
-        if r:
-            return r[0]
-        chat = self.bot.create_group(nick + " [irc]", [addr])
-        self.commit("INSERT INTO pvchats VALUES (?,?,?)", (addr, nick, chat.id))
-        return chat.id
+        with self._pvchats_lock:
+            gid = self._pvchats.get((addr, nick))
+            if gid:
+                return gid
+            chat = self.bot.create_group(nick + " [irc]", [addr])
+            self.commit("INSERT INTO pvchats VALUES (?,?,?)", (addr, nick, chat.id))
+            self._pvchats[(addr, nick)] = chat.id
+            return chat.id
 
     def get_pvchat_by_gid(self, gid: int) -> Optional[sqlite3.Row]:
         r = self.execute("SELECT * FROM pvchats WHERE chat=?", (gid,)).fetchone()
         return r
 
     def remove_pvchat(self, addr: str, nick: str) -> None:
+        self._pvchats.pop((addr, nick), None)
         self.commit("DELETE FROM pvchats WHERE addr=? AND nick=?", (addr, nick))
 
+    # ==== inboxes =====
+
+    def get_inbox(self, addr: str) -> int:
+        with self._pvchats_lock:
+            r = self.execute(
+                "SELECT chat FROM inboxes WHERE addr=?", (addr,)
+            ).fetchone()
+            if r:
+                return r[0]
+            chat = self.bot.create_group("IRC inbox [irc]", [addr])
+            self.commit("INSERT INTO inboxes VALUES (?,?)", (addr, chat.id))
+            return chat.id
+
+    def get_inbox_by_gid(self, gid: int) -> Optional[str]:
+        r = self.execute("SELECT addr FROM inboxes WHERE chat=?", (gid,)).fetchone()
+        return r and r[0]
+
+    def remove_inbox(self, addr: str) -> None:
+        self.commit("DELETE FROM inboxes WHERE addr=?", (addr,))
+
     # ==== channels =====
 
     def get_chat(self, name: str) -> Optional[int]:
@@ -85,44 +150,133 @@ class DBManager:
     # ===== nicks =======
 
     def get_nick(self, addr: str) -> str:
-        r = self.execute("SELECT nick from nicks WHERE addr=?", (addr,)).fetchone()
-        if r:
-            return r[0]
+        nick = self._nicks.get(addr)
+        if nick:
+            return nick
         allowed = string.ascii_letters + string.digits + r"_-\[]{}^`|"
         name = self.bot.get_contact(addr).name
-        name = "".join(list(filter(allowed.__contains__, name)))[:13]
-        nick = name
-        i = 2
-        while True:
-            if not self.get_addr(nick):
-                self.set_nick(addr, nick)
-                break
-            nick = f"{name}{i}"
-            if len(nick) > 13:
-                nick = name[: len(name) - 1]
-            i += 1
+        name = "".join(list(filter(allowed.__contains__, name))) or "User"
+        with self._nicks_lock:
+            nick = self._nicks.get(addr)
+            if nick:
+                return nick
+            nick = self._allocate_nick(name)
+            self._set_nick(addr, nick)
+            self._unused.add(addr)
+        self.commit("REPLACE INTO nicks VALUES (?,?)", (addr, nick))
         return nick
 
     def set_nick(self, addr: str, nick: str) -> None:
+        with self._nicks_lock:
+            self._set_nick(addr, nick)
+            self._unused.discard(addr)
         self.commit("REPLACE INTO nicks VALUES (?,?)", (addr, nick))
 
-    def get_addr(self, nick: str) -> str:
-        r = self.execute("SELECT addr FROM nicks WHERE nick=?", (nick,)).fetchone()
-        return r and r[0]
+    def get_addr(self, nick: str) -> Optional[str]:
+        return self._addrs.get(irc_lower(nick))
+
+    def nick_used(self, addr: str) -> None:
+        """Mark the user's nick as used in IRC, it will not be reallocated anymore."""
+        self._unused.discard(addr)
+
+    def reserve_nick(self, nick: str) -> None:
+        """Mark the nick as used in the IRC network by someone else for an hour.
+
+        If the nick was allocated to a user who never used it in IRC, a new nick
+        is allocated for them, nicks already used by our users are kept.
+        """
+        with self._nicks_lock:
+            now = time.monotonic()
+            for reserved, expiration in list(self._reserved.items()):
+                if expiration < now:
+                    del self._reserved[reserved]
+            self._reserved[irc_lower(nick)] = now + 60 * 60
+            addr = self._addrs.get(irc_lower(nick))
+            if addr not in self._unused:
+                return
+            nick = self._allocate_nick(nick.rstrip(string.digits) or nick)
+            self._set_nick(addr, nick)
+        self.commit("REPLACE INTO nicks VALUES (?,?)", (addr, nick))
+
+    def _set_nick(self, addr: str, nick: str) -> None:
+        old_nick = self._nicks.get(addr)
+        if old_nick:
+            self._addrs.pop(irc_lower(old_nick), None)
+        self._nicks[addr] = nick
+        self._addrs[irc_lower(nick)] = addr
+
+    def _is_nick_free(self, nick: str) -> bool:
+        nick = irc_lower(nick)
+        if nick in self._addrs:
+            return False
+        expiration = self._reserved.get(nick)
+        return expiration is None or expiration < time.monotonic()
+
+    def _allocate_nick(self, name: str) -> str:
+        name = name[:13]
+        prefix = irc_lower(name)
+        i = self._suffixes.get(prefix, 1)
+        while True:
+            nick = name if i == 1 else name[: 13 - len(str(i))] + str(i)
+            i += 1
+            if self._is_nick_free(nick):
+                break
+        self._suffixes[prefix] = i
+        return nick
 
     # ===== whitelist =======
 
     def is_whitelisted(self, name: str) -> bool:
-        rows = self.execute("SELECT channel FROM whitelist").fetchall()
-        if not rows:
+        with self._whitelist_lock:
+            if self._whitelist is None:
+                self._whitelist = self._compile_whitelist()
+            names, pattern = self._whitelist
+        if not names and not pattern:
             return True
-        for r in rows:
-            if r[0] == name:
-                return True
-        return False
+        name = irc_lower(name)
+        return name in names or bool(pattern and pattern.match(name))
+
+    def get_whitelist(self) -> List[str]:
+        return [r[0] for r in self.execute("SELECT channel FROM whitelist")]
+
+    def add_to_whitelist(self, names: Iterable[str]) -> int:
+        """Add channel names or glob patterns like "#project-*" to the whitelist.
+
+        Returns the number of channels added.
+        """
+        with self.db:
+            count = self.db.executemany(
+                "INSERT OR IGNORE INTO whitelist VALUES (?)",
+                [(irc_lower(name),) for name in names],
+            ).rowcount
+        self._invalidate_whitelist()
+        return count
+
+    def remove_from_whitelist(self, names: Iterable[str]) -> int:
+        """Remove channels from the whitelist.
+
+        Returns the number of channels removed.
+        """
+        names = {irc_lower(name) for name in names}
+        with self.db:
+            count = self.db.executemany(
+                "DELETE FROM whitelist WHERE channel=?",
+                [(r,) for r in self.get_whitelist() if irc_lower(r) in names],
+            ).rowcount
+        self._invalidate_whitelist()
+        return count
 
-    def add_to_whitelist(self, name: str) -> None:
-        self.commit("INSERT INTO whitelist VALUES (?)", (name,))
+    def _invalidate_whitelist(self) -> None:
+        with self._whitelist_lock:
+            self._whitelist = None
 
-    def remove_from_whitelist(self, name: str) -> None:
-        self.commit("DELETE FROM whitelist WHERE id=?", (name,))
+    def _compile_whitelist(self) -> Tuple[Set[str], Optional[Pattern]]:
+        names = set()
+        patterns = []
+        for name in self.get_whitelist():
+            name = irc_lower(name)
+            if "*" in name or "?" in name:
+                patterns.append(fnmatch.translate(name))
+            else:
+                names.add(name)
+        return names, re.compile("|".join(patterns)) if patterns else None
@@ -1,34 +1,123 @@
+import queue
 import string
 import time
-from threading import Thread
-from typing import Dict, Tuple
+from collections import defaultdict, deque
+from enum import Enum
+from threading import Lock, Thread
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
 
 import irc.bot
 import irc.client
 from irc.client import ServerConnection
 from simplebot.bot import DeltaBot, Replies
 
-from .database import DBManager
+from .database import DBManager, irc_lower
+from .monitor import HandlerMonitor
+
+
+class BridgeState(Enum):
+    STARTING = "starting"
+    CONNECTING = "connecting"
+    WELCOMED = "welcomed"
+
+
+class RateLimiter:
+    """Allow at most `limit` hits per key in any window of `period` seconds."""
+
+    def __init__(self, limit: int, period: float) -> None:
+        self.limit = limit
+        self.period = period
+        self._hits: Dict[str, Deque[float]] = defaultdict(deque)
+
+    def is_limited(self, key: str = "") -> bool:
+        hits = self._hits[key]
+        now = time.monotonic()
+        while hits and now - hits[0] > self.period:
+            hits.popleft()
+        if not hits:
+            del self._hits[key]
+            return self.limit <= 0
+        return len(hits) >= self.limit
+
+    def hit(self, key: str = "") -> None:
+        self._hits[key].append(time.monotonic())
 
 
 class PuppetReactor(irc.client.SimpleIRCClient):
-    def __init__(self, server, port, db: DBManager, dbot: DeltaBot) -> None:
+    def __init__(
+        self,
+        server,
+        port,
+        db: DBManager,
+        dbot: DeltaBot,
+        get_online_nicks: Callable[[List[str]], Set[str]],
+        max_pvchats_user: int,
+        max_pvchats_global: int,
+        monitor: HandlerMonitor,
+    ) -> None:
         super().__init__()
         self.server = server
         self.port = port
         self.dbot = dbot
         self.db = db
+        self.get_online_nicks = get_online_nicks
         self.puppets: Dict[str, ServerConnection] = {}
-        for chan, gid in db.get_channels():
-            for c in dbot.get_chat(gid).get_contacts():
-                if dbot.self_contact == c:
+        self.started = False
+        self.user_limiter = RateLimiter(max_pvchats_user, 60 * 60)
+        self.global_limiter = RateLimiter(max_pvchats_global, 60 * 60)
+        self.inbox_limiter = RateLimiter(100, 60 * 60)
+        # (addr, nick) -> fold time, in insertion order
+        self.folded_pvchats: Dict[Tuple[str, str], float] = {}
+        self.pending_pvchats: queue.Queue = queue.Queue(maxsize=500)
+        self._pending_lock = Lock()
+        self._pending_counts: Dict[Tuple[str, str], int] = {}
+        self._dropped_counts: Dict[str, int] = {}
+        self._connect_requests: queue.Queue = queue.Queue()
+        self.monitor = monitor
+
+    def start(self) -> None:
+        self.started = True
+        self.monitor.register_thread("puppets")
+        Thread(target=self._process_pending_pvchats, daemon=True).start()
+        self._connect_puppets()
+        self.reactor.scheduler.execute_every(1, self._process_connect_requests)
+        while True:
+            try:
+                super().start()
+            except Exception as ex:  # noqa
+                self.dbot.logger.exception("Error on puppets reactor: %s", ex)
+                time.sleep(5)
+
+    def _connect_puppets(self) -> None:
+        for chan, gid in self.db.get_channels():
+            for c in self.dbot.get_chat(gid).get_contacts():
+                if self.dbot.self_contact == c:
                     continue
                 self._get_puppet(c.addr).channels.add(chan)
-        for addr in self.puppets:
+        addrs = list(self.puppets)
+        taken = self._check_nicks(addrs)
+        for addr in addrs:
             self.dbot.logger.debug("[%s] Connecting puppet...", addr)
-            self._get_connected_puppet(addr)
+            cnn = self._get_puppet(addr)
+            if not cnn.is_connected():
+                self._connect_puppet(cnn, addr in taken)
             time.sleep(2)
 
+    def _check_nicks(self, addrs: Iterable[str]) -> Set[str]:
+        """Check the users' nicks with ISON and return the users whose nick is taken.
+
+        Nicks that were never used are replaced, the others are kept and
+        a temporary nick must be used for the connection.
+        """
+        nicks = {self.db.get_nick(addr) + "|dc": addr for addr in addrs}
+        taken = set()
+        for nick in self.get_online_nicks(list(nicks)):
+            addr = nicks[nick]
+            self.db.reserve_nick(nick[: -len("|dc")])
+            if self.db.get_nick(addr) + "|dc" == nick:
+                taken.add(addr)
+        return taken
+
     def _get_puppet(self, addr: str) -> irc.client.ServerConnection:
         cnn = self.puppets.get(addr)
         if not cnn:
@@ -37,16 +126,29 @@ class PuppetReactor(irc.client.SimpleIRCClient):
             cnn.addr = addr
             cnn.welcomed = False
             cnn.pending_actions = []
+            cnn.nick_attempts = 0
             self.puppets[addr] = cnn
         return cnn
 
-    def _get_connected_puppet(self, addr: str) -> irc.client.ServerConnection:
+    def _dispatcher(self, connection, event) -> None:
+        self.monitor.dispatch("puppets", super()._dispatcher, connection, event)
+
+    def _get_connected_puppet(
+        self, addr: str, check_nick: bool = True
+    ) -> irc.client.ServerConnection:
         cnn = self._get_puppet(addr)
         if not cnn.is_connected():
-            nick = self.db.get_nick(addr) + "|dc"
-            cnn.connect(self.server, self.port, nick, ircname=nick)
+            nick_taken = check_nick and addr in self._check_nicks([addr])
+            self._connect_puppet(cnn, nick_taken)
         return cnn
 
+    def _connect_puppet(self, cnn: ServerConnection, nick_taken: bool) -> None:
+        nick = self.db.get_nick(cnn.addr)
+        if nick_taken:
+            cnn.nick_attempts += 1
+            nick = temporary_nick(nick, cnn.nick_attempts)
+        cnn.connect(self.server, self.port, nick + "|dc", ircname=nick + "|dc")
+
     def _send_command(self, addr: str, command: str, *args) -> None:
         had_puppet = addr in self.puppets
         cnn = self._get_puppet(addr)
@@ -54,21 +156,121 @@ class PuppetReactor(irc.client.SimpleIRCClient):
             getattr(cnn, command)(*args)
         else:
             cnn.pending_actions.append((command, *args))
-            if not had_puppet:
+            if not had_puppet and self.started:
+                self._connect_requests.put(addr)
+
+    def _process_connect_requests(self) -> None:
+        # runs in the reactor thread, the nick check can block for a while
+        while not self._connect_requests.empty():
+            addr = self._connect_requests.get_nowait()
+            if addr not in self.puppets:
+                continue
+            try:
                 self._get_connected_puppet(addr)
+            except irc.client.ServerConnectionError as err:
+                self.dbot.logger.error("[%s] %s", addr, err)
 
     def _irc2dc(self, addr: str, e, impersonate: bool = True) -> None:
         if impersonate:
             sender = e.source.nick
         else:
             sender = None
-        gid = self.db.get_pvchat(addr, e.source.nick)
+        text = " ".join(e.arguments)
+        key = (addr, e.source.nick)
+        with self._pending_lock:
+            gid = self.db.find_pvchat(addr, e.source.nick)
+            if not gid or key in self._pending_counts:
+                # creating the chat is slow, don't block the reactor, messages
+                # are queued while others from the same nick are pending
+                gid = None
+                try:
+                    self.pending_pvchats.put_nowait((addr, e.source.nick, text, sender))
+                    self._pending_counts[key] = self._pending_counts.get(key, 0) + 1
+                except queue.Full:
+                    self._dropped_counts[addr] = self._dropped_counts.get(addr, 0) + 1
+        if gid:
+            self._send_to_chat(gid, text, sender)
+
+    def _send_to_chat(self, gid: int, text: str, sender: Optional[str]) -> None:
         replies = Replies(self.dbot, logger=self.dbot.logger)
-        replies.add(
-            text=" ".join(e.arguments), sender=sender, chat=self.dbot.get_chat(gid)
-        )
+        replies.add(text=text, sender=sender, chat=self.dbot.get_chat(gid))
         replies.send_reply_messages()
 
+    def _process_pending_pvchats(self) -> None:
+        while True:
+            try:
+                addr, nick, text, sender = self.pending_pvchats.get(timeout=60)
+            except queue.Empty:
+                self._report_dropped()
+                continue
+            try:
+                self._deliver_pv_message(addr, nick, text, sender)
+            except Exception as ex:  # noqa
+                self.dbot.logger.exception(
+                    "[%s] Failed to deliver message from %s: %s", addr, nick, ex
+                )
+            finally:
+                with self._pending_lock:
+                    key = (addr, nick)
+                    self._pending_counts[key] -= 1
+                    if not self._pending_counts[key]:
+                        del self._pending_counts[key]
+            if self.pending_pvchats.empty():
+                self._report_dropped()
+
+    def _is_folded(self, addr: str, nick: str) -> bool:
+        now = time.monotonic()
+        while self.folded_pvchats:
+            key, folded_time = next(iter(self.folded_pvchats.items()))
+            if now - folded_time <= self.user_limiter.period:
+                break
+            del self.folded_pvchats[key]
+        return (addr, nick) in self.folded_pvchats
+
+    def _deliver_pv_message(
+        self, addr: str, nick: str, text: str, sender: Optional[str]
+    ) -> None:
+        gid = self.db.find_pvchat(addr, nick)
+        new_fold = False
+        if not gid and not self._is_folded(addr, nick):
+            if self.user_limiter.is_limited(addr) or self.global_limiter.is_limited():
+                new_fold = True
+            else:
+                self.user_limiter.hit(addr)
+                self.global_limiter.hit()
+                gid = self.db.get_pvchat(addr, nick)
+        if not gid:
+            if self.inbox_limiter.is_limited(addr):
+                with self._pending_lock:
+                    dropped = self._dropped_counts.get(addr, 0)
+                    self._dropped_counts[addr] = dropped + 1
+                return
+            self.inbox_limiter.hit(addr)
+            gid = self.db.get_inbox(addr)
+            if new_fold:
+                if len(self.folded_pvchats) >= 1000:
+                    del self.folded_pvchats[next(iter(self.folded_pvchats))]
+                self.folded_pvchats[(addr, nick)] = time.monotonic()
+                self._send_to_chat(
+                    gid,
+                    f"** New private messages from {nick}, use /query {nick} to reply",
+                    None,
+                )
+        self._send_to_chat(gid, text, sender)
+
+    def _report_dropped(self) -> None:
+        with self._pending_lock:
+            dropped_counts, self._dropped_counts = self._dropped_counts, {}
+        for addr, count in dropped_counts.items():
+            try:
+                self._send_to_chat(
+                    self.db.get_inbox(addr),
+                    f"** {count} private messages were dropped to avoid flooding",
+                    None,
+                )
+            except Exception as ex:  # noqa
+                self.dbot.logger.exception("[%s] %s", addr, ex)
+
     def _reconnect(self, conn, _) -> bool:
         try:
             conn.welcomed = False
@@ -77,31 +279,43 @@ class PuppetReactor(irc.client.SimpleIRCClient):
                     f"Reconnecting: {conn.get_nickname()} ({conn.addr})"
                 )
                 time.sleep(15)
-                self._get_connected_puppet(conn.addr)  # reconnect
+                # the old session may still hold the nick, 433 falls back to
+                # a temporary nick
+                self._get_connected_puppet(conn.addr, check_nick=False)  # reconnect
             return True
         except irc.client.ServerConnectionError as err:
             self.dbot.logger.error("[%s] %s", conn.addr, err)
         return False
 
+    def get_welcomed_count(self) -> int:
+        return sum(1 for cnn in list(self.puppets.values()) if cnn.welcomed)
+
     def set_nick(self, addr: str, nick: str) -> None:
-        if not self.puppets[addr]:
-            self.puppets[addr].nick(nick + "|dc")
+        cnn = self.puppets.get(addr)
+        if cnn and cnn.is_connected():
+            cnn.nick(nick + "|dc")
         else:
             self.dbot.logger.warning(f"User has no puppet: {addr}")
 
     def join_channel(self, addr: str, channel: str) -> None:
-        cnn = self._get_connected_puppet(addr)
+        cnn = self._get_puppet(addr)
         cnn.channels.add(channel)
-        cnn.join(channel)
+        if cnn.welcomed:
+            cnn.join(channel)
+        elif self.started:
+            # the channel is joined on welcome
+            self._connect_requests.put(addr)
 
     def leave_channel(self, addr: str, channel: str) -> None:
-        cnn = self._get_connected_puppet(addr)
-        if channel in cnn.channels:
-            cnn.channels.discard(channel)
+        cnn = self.puppets.get(addr)
+        if not cnn or channel not in cnn.channels:
+            return
+        cnn.channels.discard(channel)
+        if cnn.welcomed:
             cnn.part(channel)
-            if not cnn.channels:
-                del self.puppets[addr]
-                cnn.close()
+        if not cnn.channels:
+            del self.puppets[addr]
+            cnn.close()
 
     def send_message(self, addr: str, target: str, text: str) -> None:
         self._send_command(addr, "privmsg", target, text)
@@ -113,16 +327,20 @@ class PuppetReactor(irc.client.SimpleIRCClient):
 
     def on_nicknameinuse(self, conn, _) -> None:
         nick = self.db.get_nick(conn.addr)
-        if len(nick) < 13:
-            nick += "_"
+        self.db.reserve_nick(nick)
+        if self.db.get_nick(conn.addr) == nick:
+            # keep the user's nick, it may be held by an old session
+            conn.nick_attempts += 1
+            nick = temporary_nick(nick, conn.nick_attempts)
         else:
-            nick = nick[: len(nick) - 1]
-        self.db.set_nick(conn.addr, nick)
+            nick = self.db.get_nick(conn.addr)
         conn.nick(nick + "|dc")
 
-    @staticmethod
-    def on_welcome(conn, _) -> None:
+    def on_welcome(self, conn, _) -> None:
         conn.welcomed = True
+        conn.nick_attempts = 0
+        if conn.get_nickname() == self.db.get_nick(conn.addr) + "|dc":
+            self.db.nick_used(conn.addr)
         for channel in conn.channels:
             time.sleep(2)
             conn.join(channel)
@@ -152,7 +370,14 @@ class PuppetReactor(irc.client.SimpleIRCClient):
 
 class IRCBot(irc.bot.SingleServerIRCBot):
     def __init__(
-        self, server: Tuple[str, int], nick: str, db: DBManager, dbot: DeltaBot
+        self,
+        server: Tuple[str, int],
+        nick: str,
+        db: DBManager,
+        dbot: DeltaBot,
+        max_pvchats_user: int = 5,
+        max_pvchats_global: int = 50,
+        monitor: Optional[HandlerMonitor] = None,
     ) -> None:
         nick = sanitize_nick(nick)
         self.nick = nick
@@ -160,8 +385,39 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         super().__init__([(self.server, self.port)], nick, nick)
         self.dbot = dbot
         self.db = db
-        self.preactor = PuppetReactor(self.server, self.port, db, dbot)
+        self.monitor = monitor or HandlerMonitor(dbot.logger)
+        self.preactor = PuppetReactor(
+            self.server,
+            self.port,
+            db,
+            dbot,
+            self.get_online_nicks,
+            max_pvchats_user,
+            max_pvchats_global,
+            self.monitor,
+        )
         self.nick_counter = 1
+        self.state = BridgeState.STARTING
+        self._ison_lock = Lock()
+        self._ison_replies: queue.Queue = queue.Queue()
+
+    def start(self) -> None:
+        self.state = BridgeState.CONNECTING
+        self.monitor.register_thread("bot")
+        super().start()
+
+    def _dispatcher(self, connection, event) -> None:
+        self.monitor.dispatch("bot", super()._dispatcher, connection, event)
+
+    def is_ready(self) -> bool:
+        return self.state == BridgeState.WELCOMED
+
+    def get_status(self) -> str:
+        if not self.is_ready():
+            return f"⏳ IRC bridge starting ({self.state.value}), try again later"
+        ready = self.preactor.get_welcomed_count()
+        total = len(self.preactor.puppets)
+        return f"✔️ IRC bridge ready, puppets {ready}/{total} connected"
 
     def _irc2dc(self, event) -> None:
         for cnn in self.preactor.puppets.values():
@@ -194,7 +450,10 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         for chan, _ in self.db.get_channels():
             time.sleep(2)
             conn.join(chan)
-        Thread(target=self.preactor.start, daemon=True).start()
+        # ISON replies can't be processed until this handler returns
+        self.state = BridgeState.WELCOMED
+        if not self.preactor.started:
+            Thread(target=self.preactor.start, daemon=True).start()
 
     def on_action(self, _, event) -> None:
         event.arguments.insert(0, "/me")
@@ -203,6 +462,9 @@ class IRCBot(irc.bot.SingleServerIRCBot):
     def on_pubmsg(self, _, event) -> None:
         self._irc2dc(event)
 
+    def on_ison(self, _, event) -> None:
+        self._ison_replies.put(event.arguments[0] if event.arguments else "")
+
     def on_notopic(self, _, event) -> None:
         chan = self.channels[event.arguments[0]]
         chan.topic = "-"
@@ -215,6 +477,7 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         self.dbot.logger.error("[bot] %s", event)
 
     def on_disconnect(self, conn, event) -> None:
+        self.state = BridgeState.CONNECTING
         while not self._reconnect(conn, event):
             time.sleep(15)
 
@@ -229,12 +492,15 @@ class IRCBot(irc.bot.SingleServerIRCBot):
         return False
 
     def join_channel(self, name: str) -> None:
-        self.connection.join(name)
+        # channels are joined on welcome if still connecting
+        if self.is_ready():
+            self.connection.join(name)
 
     def leave_channel(self, channel: str) -> None:
         for addr in list(self.preactor.puppets.keys()):
             self.preactor.leave_channel(addr, channel)
-        self.connection.part(channel)
+        if self.is_ready():
+            self.connection.part(channel)
 
     def get_topic(self, channel: str) -> str:
         self.connection.topic(channel)
@@ -249,6 +515,37 @@ class IRCBot(irc.bot.SingleServerIRCBot):
     def send_message(self, target: str, text: str) -> None:
         self.connection.privmsg(target, text)
 
+    def get_online_nicks(self, nicks: List[str], timeout: float = 5) -> Set[str]:
+        """Return the given nicks that are online, querying them in ISON batches.
+
+        Must not be called from the bot's reactor thread.
+        """
+        online: Set[str] = set()
+        if not self.is_ready():
+            return online
+        lowered = {irc_lower(nick): nick for nick in nicks}
+        with self._ison_lock:
+            for i in range(0, len(nicks), 20):  # keep lines below 512 bytes
+                while not self._ison_replies.empty():  # drop late replies
+                    self._ison_replies.get_nowait()
+                try:
+                    self.connection.ison(nicks[i : i + 20])
+                    reply = self._ison_replies.get(timeout=timeout)
+                except irc.client.ServerNotConnectedError:
+                    break
+                except queue.Empty:
+                    self.dbot.logger.warning("[bot] ISON reply timed out")
+                    break
+                for nick in reply.split():
+                    if irc_lower(nick) in lowered:
+                        online.add(lowered[irc_lower(nick)])
+        return online
+
+
+def temporary_nick(nick: str, attempt: int) -> str:
+    suffix = "_" * attempt if attempt <= 3 else f"_{attempt}"
+    return nick[: 13 - len(suffix)] + suffix
+
 
 def sanitize_nick(nick: str) -> str:
     allowed = string.ascii_letters + string.digits + r"_-\[]{}^`|"
@@ -0,0 +1,142 @@
+import sys
+import time
+import traceback
+from collections import Counter
+from threading import Event, Lock, Thread, get_ident
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class HandlerMonitor:
+    """Time IRC event handlers and report the ones that block a reactor thread."""
+
+    def __init__(self, logger, threshold: float = 10) -> None:
+        self.logger = logger
+        self.threshold = threshold
+        self.enabled = False
+        self.threads: Dict[int, str] = {}  # thread ident -> reactor name
+        # reactor:event -> [calls, total time, max time]
+        self.stats: Dict[str, List[float]] = {}
+        # thread ident -> (reactor:event, target, start time)
+        self._active: Dict[int, Tuple[str, str, float]] = {}
+        self._watchdog: Optional[Thread] = None
+        self._watchdog_lock = Lock()
+        self._enabled_event = Event()
+        self._sampling_lock = Lock()
+        self._stop_sampling = Event()
+
+    def register_thread(self, name: str) -> None:
+        """Register the calling thread as the reactor thread with the given name."""
+        self.threads[get_ident()] = name
+
+    def set_enabled(self, enabled: bool) -> None:
+        self.enabled = enabled
+        if not enabled:
+            self._enabled_event.clear()
+            return
+        self._enabled_event.set()
+        with self._watchdog_lock:
+            if not self._watchdog:
+                self._watchdog = Thread(target=self._watch, daemon=True)
+                self._watchdog.start()
+
+    def dispatch(self, reactor: str, handler: Callable, connection, event) -> None:
+        if not self.enabled:
+            handler(connection, event)
+            return
+
+        key = f"{reactor}:{event.type}"
+        ident = get_ident()
+        start = time.perf_counter()
+        self._active[ident] = (key, getattr(connection, "addr", reactor), start)
+        try:
+            handler(connection, event)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._active.pop(ident, None)
+            stats = self.stats.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def get_stats(self, limit: int = 20) -> str:
+        rows = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+        lines = []
+        for key, (calls, total, max_time) in rows[:limit]:
+            lines.append(
+                f"{key}: {int(calls)} calls, total {total:.2f}s,"
+                f" avg {total / calls * 1000:.1f}ms, max {max_time * 1000:.1f}ms"
+            )
+        return "\n".join(lines)
+
+    def sample(self, seconds: float, interval: float = 0.01) -> Optional[str]:
+        """Sample the stacks of the reactor threads for the given time.
+
+        Returns None if another sampling is already running.
+        """
+        if not self._sampling_lock.acquire(blocking=False):
+            return None
+        try:
+            self._stop_sampling.clear()
+            leaves: Counter = Counter()
+            functions: Counter = Counter()
+            samples = 0
+            end = time.monotonic() + seconds
+            while time.monotonic() < end and not self._stop_sampling.is_set():
+                frames = sys._current_frames()  # noqa
+                for ident, name in list(self.threads.items()):
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    leaves[f"{name} {_format_frame(frame)}"] += 1
+                    seen = set()
+                    while frame is not None:
+                        code = frame.f_code
+                        seen.add(f"{name} {code.co_filename}:{code.co_name}")
+                        frame = frame.f_back
+                    functions.update(seen)
+                samples += 1
+                time.sleep(interval)
+        finally:
+            self._sampling_lock.release()
+
+        if not samples:
+            return "No samples collected"
+        lines = [f"{samples} samples", "", "Top frames:"]
+        for frame, count in leaves.most_common(10):
+            lines.append(f"{count / samples:6.1%} {frame}")
+        lines.extend(["", "Top functions (inclusive):"])
+        for func, count in functions.most_common(15):
+            lines.append(f"{count / samples:6.1%} {func}")
+        return "\n".join(lines)
+
+    def stop_sampling(self) -> bool:
+        """Stop the running sampling, returns False if there is no sampling running."""
+        if not self._sampling_lock.locked():
+            return False
+        self._stop_sampling.set()
+        return True
+
+    def _watch(self) -> None:
+        reported: Dict[int, float] = {}
+        while True:
+            self._enabled_event.wait()
+            time.sleep(max(0.1, min(1, self.threshold / 2)))
+            now = time.perf_counter()
+            for ident, (key, target, start) in list(self._active.items()):
+                if now - start < self.threshold or reported.get(ident) == start:
+                    continue
+                reported[ident] = start
+                frame = sys._current_frames().get(ident)  # noqa
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                self.logger.warning(
+                    "[monitor] %s handler for %s blocked for %.1fs:\n%s",
+                    key,
+                    target,
+                    now - start,
+                    stack,
+                )
+
+
+def _format_frame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_filename}:{frame.f_lineno}:{code.co_name}"